@@ -1,8 +1,14 @@
+import bisect
+import concurrent.futures
 import enum
+import errno
+import functools
+import itertools
 import os
-import platform
-import shutil
 import subprocess
+import sys
+import threading
+import xml.etree.ElementTree as ElementTree
 
 import sublime
 import sublime_plugin
@@ -13,32 +19,34 @@ class Formatter(enum.Enum):
     """
     Formatters supported by this plugin.
     """
-    AutoPep8 = enum.auto()
-    ClangFormat = enum.auto()
-    Gn = enum.auto()
-    Prettier = enum.auto()
-    RustFmt = enum.auto()
+    AutoPep8 = 'autopep8'
+    ClangFormat = 'clang-format'
+    Gn = 'gn'
+    Prettier = 'prettier'
+    RustFmt = 'rustfmt'
 
     def __str__(self):
-        if self is Formatter.AutoPep8:
-            return 'autopep8'
-        elif self is Formatter.ClangFormat:
-            return 'clang-format'
-        elif self is Formatter.Gn:
-            return 'gn'
-        elif self is Formatter.Prettier:
-            return 'prettier'
-        elif self is Formatter.RustFmt:
-            return 'rustfmt'
-
-
-# List of possible names the formatters may have.
-if os.name == 'nt':
+        return self.value
+
+
+# The operating system the plugin is running on.
+IS_WINDOWS = os.name == 'nt'
+
+# On Windows, prevent a command prompt from showing when running formatters.
+if IS_WINDOWS:
+    STARTUP_INFO = subprocess.STARTUPINFO()
+    STARTUP_INFO.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+else:
+    STARTUP_INFO = None
+
+# List of possible names the formatters may have, in order of preference. The prettierd daemon is
+# preferred over prettier, as it avoids the startup cost of Node.js on every invocation.
+if IS_WINDOWS:
     FORMATTERS = {
         Formatter.AutoPep8: ['autopep8.cmd', 'autopep8.exe'],
         Formatter.ClangFormat: ['clang-format.bat', 'clang-format.exe'],
         Formatter.Gn: ['gn.exe'],
-        Formatter.Prettier: ['prettier.cmd', 'prettier.exe'],
+        Formatter.Prettier: ['prettierd.cmd', 'prettier.cmd', 'prettier.exe'],
         Formatter.RustFmt: ['rustfmt.exe'],
     }
 else:
@@ -46,36 +54,95 @@ else:
         Formatter.AutoPep8: ['autopep8'],
         Formatter.ClangFormat: ['clang-format'],
         Formatter.Gn: ['gn'],
-        Formatter.Prettier: ['prettier'],
+        Formatter.Prettier: ['prettierd', 'prettier'],
         Formatter.RustFmt: ['rustfmt'],
     }
 
-# List of languages supported for use with the formatters.
+# List of languages supported for use with the formatters. These are tuples so that they may be
+# passed directly to str.endswith.
 LANGUAGES = {
-    Formatter.AutoPep8: ['Python'],
-    Formatter.ClangFormat: ['C', 'C++', 'Objective-C', 'Objective-C++', 'Java'],
-    Formatter.Gn: ['GN'],
-    Formatter.Prettier: ['HTML', 'JavaScript', 'JavaScript (Babel)', 'JSON', 'TypeScript'],
-    Formatter.RustFmt: ['Rust'],
+    Formatter.AutoPep8: ('Python',),
+    Formatter.ClangFormat: ('C', 'C++', 'Objective-C', 'Objective-C++', 'Java'),
+    Formatter.Gn: ('GN',),
+    Formatter.Prettier: ('HTML', 'JavaScript', 'JavaScript (Babel)', 'JSON', 'TypeScript'),
+    Formatter.RustFmt: ('Rust',),
+}
+
+# Mapping of supported language names to the formatter to use for that language.
+SYNTAXES = {
+    language: formatter for (formatter, languages) in LANGUAGES.items() for language in languages
 }
 
+# Executor used to run formatters off of the UI thread.
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+
+# Formatters which have been submitted to the executor, keyed by view. Only modified on the UI
+# thread.
+PENDING_FORMATS = {}
+
+# Set of views which are being saved by this plugin after being formatted on save.
+SAVING_VIEWS = set()
+
+# Change counts of views as of the last time they were formatted on save, keyed by view.
+FORMATTED_VIEWS = {}
+
+# Number of characters to read from a view and write to a formatter's standard input at a time.
+PIPE_CHUNK_SIZE = 64 * 1024
+
+# Cache of the format settings of each window's project, keyed by window.
+PROJECT_SETTINGS = {}
+
+# Cache of the named folders of each window's project, keyed by window.
+FOLDER_DATA = {}
+
+# Cache of the paths to the folders for which format-on-save is enabled, keyed by window and then
+# by the names of the enabled folders.
+ENABLED_FOLDERS = {}
+
+# Cache of resolved project settings, keyed by window, formatter, and setting name.
+SETTINGS_CACHE = {}
+
+# Cache of resolved formatters and binaries, keyed by view.
+VIEW_CACHE = {}
+
+# Cache of binaries that have been found for each formatter, keyed by the locations searched.
+BINARY_CACHE = {}
+
 
 def add_to_path(directory):
     """
     Add a path to the system PATH if it is not already present.
     """
     is_directory = lambda d: d and os.path.isdir(d) and os.access(d, os.R_OK)
-    path = os.environ['PATH'].split(os.pathsep)
+    path = split_path(os.environ['PATH'])
 
     if is_directory(directory) and directory not in path:
-        path.append(directory)
-        os.environ['PATH'] = os.pathsep.join(path)
+        os.environ['PATH'] = os.pathsep.join(path + (directory,))
+        expand_variables.cache_clear()
+
+
+@functools.lru_cache(maxsize=256)
+def expand_variables(value):
+    """
+    Expand environment variables in the given string. Expansions are cached, and the cache must be
+    cleared whenever the system environment is modified.
+    """
+    return os.path.expandvars(value)
+
+
+@functools.lru_cache(maxsize=1)
+def split_path(path):
+    """
+    Split a PATH string into a tuple of its directories. The most recent result is cached, so the
+    system PATH is only split again once it changes.
+    """
+    return tuple(path.split(os.pathsep))
 
 
 # Add OS-specific locations to the system PATH for convenience.
-if platform.system() == 'Linux':
+if sys.platform.startswith('linux'):
     add_to_path(os.path.join(os.path.expanduser('~'), '.local', 'bin'))
-elif platform.system() == 'Darwin':
+elif sys.platform == 'darwin':
     add_to_path(os.path.join(os.path.sep, 'opt', 'homebrew', 'bin'))
 
 
@@ -88,7 +155,7 @@ def is_supported_language(formatter, view):
         return False
 
     (syntax, _) = os.path.splitext(syntax)
-    supported = any(syntax.endswith(lang) for lang in LANGUAGES[formatter])
+    supported = syntax.endswith(LANGUAGES[formatter])
 
     return supported and bool(view.file_name())
 
@@ -97,6 +164,17 @@ def formatter_type(view):
     """
     Return the type of formatter to use for the given view, if any.
     """
+    syntax = view.settings().get('syntax')
+    if (syntax is None) or not view.file_name():
+        return None
+
+    # Most syntaxes are named exactly after their language, so try a direct lookup first. Otherwise,
+    # fall back onto suffix matching the syntax against each formatter's languages.
+    (syntax, _) = os.path.splitext(os.path.basename(syntax))
+
+    if syntax in SYNTAXES:
+        return SYNTAXES[syntax]
+
     for formatter in Formatter:
         if is_supported_language(formatter, view):
             return formatter
@@ -104,21 +182,80 @@ def formatter_type(view):
     return None
 
 
+def resolve_formatter(view):
+    """
+    Return the type of formatter and the formatter binary to use for the given view, if any.
+
+    The result is cached for each view until the view's syntax or file name changes, or until the
+    view is activated again.
+    """
+    key = (view.settings().get('syntax'), view.file_name())
+    cached = VIEW_CACHE.get(view.id())
+
+    if cached and (cached[0] == key):
+        return cached[1]
+
+    formatter = formatter_type(view)
+    binary = None
+
+    if formatter is not None:
+        path = get_project_setting(formatter, 'path')
+        binary = find_binary(formatter, path, view)
+
+    VIEW_CACHE[view.id()] = (key, (formatter, binary))
+    return (formatter, binary)
+
+
 def get_project_setting(formatter, setting_key):
     """
     Load a project setting from the active window, with environment variable expansion for string
     settings.
+
+    Resolved settings are cached per window, and are only resolved again if the project's format
+    settings have been reloaded since the setting was last loaded.
     """
-    project_data = sublime.active_window().project_data()
-    if not project_data or ('settings' not in project_data):
-        return None
+    window = sublime.active_window()
 
-    settings = project_data['settings']
-    if 'format' not in project_data['settings']:
+    settings = get_format_settings(window)
+    if settings is None:
         return None
 
-    settings = settings['format']
+    key = (window.id(), formatter, setting_key)
+    cached = SETTINGS_CACHE.get(key)
 
+    if cached and (cached[0] is settings):
+        return cached[1]
+
+    setting = resolve_project_setting(settings, formatter, setting_key)
+    SETTINGS_CACHE[key] = (settings, setting)
+
+    return setting
+
+
+def get_format_settings(window):
+    """
+    Load the format settings from the given window's project data, if any. The settings are cached
+    per window until invalidated by FormatFileListener, to avoid copying the project data from
+    Sublime on every lookup.
+    """
+    if window.id() in PROJECT_SETTINGS:
+        return PROJECT_SETTINGS[window.id()]
+
+    project_data = window.project_data()
+    settings = None
+
+    if project_data and ('settings' in project_data):
+        settings = project_data['settings'].get('format')
+
+    PROJECT_SETTINGS[window.id()] = settings
+    return settings
+
+
+def resolve_project_setting(settings, formatter, setting_key):
+    """
+    Resolve a setting from a project's format settings, with environment variable expansion for
+    string settings.
+    """
     if formatter:
         formatter = str(formatter)
         if formatter not in settings:
@@ -132,18 +269,47 @@ def get_project_setting(formatter, setting_key):
     setting = settings[setting_key]
 
     if isinstance(setting, str):
-        return os.path.expandvars(setting)
+        return expand_variables(setting)
 
     return setting
 
 
-def find_binary(formatter, directory, view):
+def find_binary(formatter, directory, view, binaries=None):
     """
     Search for one of a list of binaries in the given directory or on the system PATH. Return the
-    first valid binary that is found.
+    first valid binary that is found. By default, all possible names of the formatter are searched.
+
+    Binaries which are found are cached, so subsequent lookups for the same formatter and search
+    locations (including the system PATH) do not need to scan the file system again. The cache is
+    cleared whenever a view is activated, so that moved, deleted, or newly installed binaries are
+    noticed.
     """
-    binaries = FORMATTERS[formatter]
+    project_path = None
+
+    if formatter is Formatter.Prettier:
+        for folder in view.window().folders():
+            if view.file_name().startswith(folder):
+                project_path = os.path.join(folder, 'node_modules', '.bin')
+                break
+
+    binaries = tuple(binaries or FORMATTERS[formatter])
+    key = (formatter, binaries, directory, project_path, os.environ['PATH'])
+
+    if key not in BINARY_CACHE:
+        binary = search_for_binary(formatter, binaries, directory, project_path)
+        if binary is None:
+            return None
+
+        BINARY_CACHE[key] = binary
+
+    return BINARY_CACHE[key]
+
 
+def search_for_binary(formatter, binaries, directory, project_path):
+    """
+    Search the file system for one of a list of binaries for the given formatter. The given project
+    path is searched as a fallback for formatters which may be installed per-project.
+    """
     is_directory = lambda d: d and os.path.isdir(d) and os.access(d, os.R_OK)
     is_binary = lambda f: f and os.path.isfile(f) and os.access(f, os.X_OK)
 
@@ -155,19 +321,12 @@ def find_binary(formatter, directory, view):
 
     # Then fallback onto the system PATH.
     for binary in binaries:
-        binary = shutil.which(binary)
+        binary = which(binary)
         if is_binary(binary):
             return binary
 
     # Otherwise, fallback onto formatter-specific common locations.
     if formatter is Formatter.Prettier:
-        for project_path in view.window().folders():
-            if view.file_name().startswith(project_path):
-                project_path = os.path.join(project_path, 'node_modules', '.bin')
-                break
-        else:
-            project_path = None
-
         for binary in (binaries if is_directory(project_path) else []):
             binary = os.path.join(project_path, binary)
             if is_binary(binary):
@@ -184,22 +343,62 @@ def find_binary(formatter, directory, view):
     return None
 
 
-def execute_command(command, working_directory, stdin=None, extra_environment=None):
+def which(binary):
+    """
+    Search the system PATH for the given binary. Unlike shutil.which, the binary name is matched
+    exactly (without trying each PATHEXT extension on Windows), and each PATH directory's listing is
+    cached so that searching for multiple binaries does not stat every candidate path.
+    """
+    name = os.path.normcase(binary)
+
+    for directory in split_path(os.environ['PATH']):
+        if not directory or (name not in list_directory(directory)):
+            continue
+
+        path = os.path.join(directory, binary)
+
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def list_directory(directory):
     """
-    Execute a command list in the given working directory, optionally piping in an input string.
-    Returns the standard output of the command, or None if an error occurred.
+    Return the set of file names in the given directory, normalized for case-insensitive file
+    systems.
     """
-    environment = os.environ.copy()
-    startup_info = None
+    try:
+        with os.scandir(directory) as entries:
+            return frozenset(os.path.normcase(entry.name) for entry in entries)
+    except OSError:
+        return frozenset()
 
-    # On Windows, prevent a command prompt from showing.
-    if os.name == 'nt':
-        startup_info = subprocess.STARTUPINFO()
-        startup_info.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
+def is_prettierd(binary):
+    """
+    Check if the given binary is the prettierd daemon rather than prettier itself.
+    """
+    (name, _) = os.path.splitext(os.path.basename(binary))
+    return name == 'prettierd'
+
+
+def execute_command(command, working_directory, stdin=None, extra_environment=None):
+    """
+    Execute a command list in the given working directory, optionally piping in a list of encoded
+    input chunks. Returns the undecoded standard output of the command, or None if an error
+    occurred.
+    """
+    environment = None
+
+    # Only copy the system environment if it needs to be extended. Otherwise, the subprocess will
+    # inherit the environment as-is.
     if extra_environment:
+        environment = os.environ.copy()
+
         for (key, value) in extra_environment.items():
-            environment[key] = os.path.expandvars(value)
+            environment[key] = expand_variables(value)
 
     try:
         encoding = 'utf-8'
@@ -209,18 +408,15 @@ def execute_command(command, working_directory, stdin=None, extra_environment=No
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            startupinfo=startup_info,
+            startupinfo=STARTUP_INFO,
             cwd=working_directory,
             env=environment,
         )
 
-        if stdin:
-            stdin = stdin.encode(encoding)
-
-        (stdout, stderr) = process.communicate(input=stdin)
+        (stdout, stderr) = communicate(process, stdin)
 
         if process.returncode == 0:
-            return stdout.decode(encoding) if stdout else None
+            return stdout if stdout else None
 
         if stderr:
             sublime.error_message(f'Error: {stderr.decode(encoding)}')
@@ -235,6 +431,137 @@ def execute_command(command, working_directory, stdin=None, extra_environment=No
     return None
 
 
+def chunk_offsets(encoded):
+    """
+    Compute the byte offset at which each UTF-8 encoded input chunk begins, followed by the total
+    length of the encoded input.
+    """
+    return list(itertools.accumulate(itertools.chain((0,), map(len, encoded))))
+
+
+def to_byte_offset(offset, contents, starts):
+    """
+    Convert a character offset into the input chunks to a byte offset into the UTF-8 encoded input
+    chunks. Each chunk other than the last holds exactly PIPE_CHUNK_SIZE characters, so only the
+    chunk containing the offset needs to be encoded again.
+    """
+    (index, offset) = divmod(offset, PIPE_CHUNK_SIZE)
+
+    if index >= len(contents):
+        return starts[-1]
+
+    return starts[index] + len(contents[index][:offset].encode('utf-8'))
+
+
+def to_char_offset(offset, encoded, starts):
+    """
+    Convert a byte offset into the UTF-8 encoded input chunks to a character offset. Each chunk
+    other than the last holds exactly PIPE_CHUNK_SIZE characters, so only the chunk containing the
+    offset needs to be decoded.
+    """
+    if not encoded:
+        return 0
+
+    index = max(bisect.bisect_right(starts, offset, 0, len(encoded)) - 1, 0)
+    chunk = encoded[index][:offset - starts[index]]
+
+    return (index * PIPE_CHUNK_SIZE) + len(chunk.decode('utf-8'))
+
+
+def parse_replacements(output, encoded):
+    """
+    Parse the output of clang-format's -output-replacements-xml option into a list of replacements,
+    sorted by offset. clang-format reports offsets in bytes of the UTF-8 encoded input, so they are
+    converted to character offsets into the given encoded input chunks. Returns None if the output
+    is invalid.
+    """
+    try:
+        replacements = sorted(
+            (int(replacement.get('offset')), int(replacement.get('length')), replacement.text or '')
+            for replacement in ElementTree.fromstring(output).iter('replacement'))
+    except (ElementTree.ParseError, TypeError, ValueError) as ex:
+        sublime.error_message(f'Exception: {ex}')
+        return None
+
+    if not replacements:
+        return []
+
+    starts = chunk_offsets(encoded)
+
+    try:
+        return [
+            (
+                to_char_offset(offset, encoded, starts),
+                to_char_offset(offset + length, encoded, starts),
+                text,
+            )
+            for (offset, length, text) in replacements
+        ]
+    except UnicodeDecodeError as ex:
+        sublime.error_message(f'Exception: {ex}')
+        return None
+
+
+def is_unchanged(output, encoded):
+    """
+    Check if a formatter's undecoded output is identical to the encoded input chunks that were given
+    to it. The comparison is done on encoded bytes so that unchanged output never needs to be
+    decoded.
+    """
+    offset = 0
+
+    for chunk in encoded:
+        if not output.startswith(chunk, offset):
+            return False
+
+        offset += len(chunk)
+
+    return offset == len(output)
+
+
+def communicate(process, encoded):
+    """
+    Stream a list of encoded input chunks to a process while concurrently reading its standard
+    output and standard error. Unlike Popen.communicate, the input is written one chunk at a time,
+    so the chunks are never joined into a single copy of the entire input. Returns the process'
+    standard output and standard error once it has exited.
+    """
+    errors = []
+
+    def write_input():
+        try:
+            with process.stdin:
+                for chunk in (encoded or []):
+                    process.stdin.write(chunk)
+        except BrokenPipeError:
+            # The process exited before reading all of its input, which will be reflected in its
+            # exit status.
+            pass
+        except OSError as ex:
+            # On Windows, writing to a process which has already exited raises EINVAL instead.
+            if ex.errno != errno.EINVAL:
+                raise
+
+    def read_errors():
+        errors.append(process.stderr.read())
+
+    threads = [threading.Thread(target=write_input), threading.Thread(target=read_errors)]
+
+    for thread in threads:
+        thread.start()
+
+    with process.stdout:
+        output = process.stdout.read()
+
+    for thread in threads:
+        thread.join()
+
+    process.stderr.close()
+    process.wait()
+
+    return (output, errors[0])
+
+
 class FormatFileCommand(sublime_plugin.TextCommand):
     """
     Command to format a file on demand. If any selections are active, only those selections are
@@ -264,95 +591,241 @@ class FormatFileCommand(sublime_plugin.TextCommand):
 
     def __init__(self, *args, **kwargs):
         super(FormatFileCommand, self).__init__(*args, **kwargs)
-        self.initialize()
 
-    def initialize(self):
-        self.environment = get_project_setting(None, 'environment')
-        self.formatter = formatter_type(self.view)
+        # Sublime creates an instance of this command for every view, so the formatter is not
+        # resolved until the command is actually queried or run.
+        self.formatter = None
         self.binary = None
+        self.prefix_key = None
+        self.prefix = None
 
-        if self.formatter is not None:
-            path = get_project_setting(self.formatter, 'path')
-            self.binary = find_binary(self.formatter, path, self.view)
+    def initialize(self):
+        (self.formatter, self.binary) = resolve_formatter(self.view)
+
+    def run(self, edit, ignore_selections=False, save=False, formatter=None, binary=None):
+        # Callers which have already resolved the formatter and binary may provide them directly.
+        if (formatter is not None) and (binary is not None):
+            self.formatter = Formatter(formatter)
+            self.binary = binary
+        elif not self.is_enabled():
+            return
+
+        environment = get_project_setting(None, 'environment')
 
-    def run(self, edit, ignore_selections=False):
         if ignore_selections or (len(self.view.sel()) == 0):
-            selected_regions = lambda: []
+            regions = []
         else:
-            selected_regions = lambda: [region for region in self.view.sel() if not region.empty()]
+            regions = [region for region in self.view.sel() if not region.empty()]
 
-        command = [self.binary]
+        binary = self.binary
+
+        # prettierd always formats the entire file, so selections are formatted with prettier
+        # itself if it is installed.
+        if regions and (self.formatter is Formatter.Prettier) and is_prettierd(binary):
+            path = get_project_setting(self.formatter, 'path')
+            binaries = [b for b in FORMATTERS[self.formatter] if not is_prettierd(b)]
+
+            binary = find_binary(self.formatter, path, self.view, binaries) or binary
+
+        command = list(self.command_prefix(binary))
 
         if self.formatter is Formatter.AutoPep8:
-            for region in selected_regions():
-                (begin, _) = self.view.rowcol(region.begin())
-                (end, _) = self.view.rowcol(region.end())
+            # autopep8 only supports formatting a single range of lines, so format the range of
+            # lines spanning all selections in one invocation.
+            if regions:
+                (begin, _) = self.view.rowcol(min(region.begin() for region in regions))
+                (end, _) = self.view.rowcol(max(region.end() for region in regions))
                 command.extend(['--line-range', str(begin + 1), str(end + 1)])
-                break
 
             command.append('-')
 
-        elif self.formatter is Formatter.ClangFormat:
-            command.extend(['-assume-filename', self.view.file_name()])
+        elif self.formatter is Formatter.Prettier and not is_prettierd(binary):
+            # Similarly, prettier only supports formatting a single range.
+            if regions:
+                command.extend(['--range-start', str(min(region.begin() for region in regions))])
+                command.extend(['--range-end', str(max(region.end() for region in regions))])
+
+        working_directory = os.path.dirname(self.view.file_name())
+
+        # Read the file in chunks rather than as one large string. The chunks are encoded once in
+        # the background, piped to the formatter one at a time, and reused to interpret its output.
+        size = self.view.size()
+        contents = [
+            self.view.substr(sublime.Region(i, min(i + PIPE_CHUNK_SIZE, size)))
+            for i in range(0, size, PIPE_CHUNK_SIZE)
+        ]
+
+        # Run the formatter in the background, and then apply its result on the UI thread. The
+        # result is discarded if the view is modified in the meantime.
+        view = self.view
+        formatter = self.formatter
+        change_count = view.change_count()
+
+        def clear_pending(future):
+            if PENDING_FORMATS.get(view.id()) is future:
+                del PENDING_FORMATS[view.id()]
+
+        def on_formatted(future):
+            # PENDING_FORMATS is only modified on the UI thread, so clear this format from there.
+            sublime.set_timeout(lambda: clear_pending(future))
+
+            if future.cancelled():
+                return
+
+            (output, encoded) = future.result()
+            if not output:
+                return
+
+            # clang-format outputs only the edits to make, whereas other formatters output the
+            # entire formatted file.
+            if formatter is Formatter.ClangFormat:
+                replacements = parse_replacements(output, encoded)
+            elif not is_unchanged(output, encoded):
+                try:
+                    replacements = [(0, size, output.decode('utf-8'))]
+                except UnicodeDecodeError as ex:
+                    sublime.error_message(f'Exception: {ex}')
+                    return
+            else:
+                replacements = []
+
+            if replacements is None:
+                return
+
+            # Leave the view untouched if the file was already formatted. This avoids rewriting the
+            # buffer (and creating an undo entry) for a no-op.
+            if not replacements:
+                if save:
+                    FORMATTED_VIEWS[view.id()] = change_count
+                return
+
+            args = {'replacements': replacements, 'change_count': change_count, 'save': save}
+            sublime.set_timeout(lambda: view.run_command('format_file_replace', args))
+
+        # If the view is still waiting on a previous format to start (e.g. after rapid successive
+        # saves), that format is superseded by this one.
+        pending = PENDING_FORMATS.pop(view.id(), None)
+
+        if pending is not None:
+            pending.cancel()
+
+        def format_contents():
+            encoded = [chunk.encode('utf-8') for chunk in contents]
+            arguments = command
+
+            # clang-format expects its ranges in bytes of the UTF-8 encoded input, so they may only
+            # be computed once the input has been encoded.
+            if formatter is Formatter.ClangFormat and regions:
+                starts = chunk_offsets(encoded)
+
+                def byte_range(region):
+                    begin = to_byte_offset(region.begin(), contents, starts)
+                    end = to_byte_offset(region.end(), contents, starts)
+
+                    return ('-offset', str(begin), '-length', str(end - begin))
 
-            for region in selected_regions():
-                command.extend(['-offset', str(region.begin())])
-                command.extend(['-length', str(region.size())])
+                arguments = command + list(itertools.chain.from_iterable(map(byte_range, regions)))
+
+            output = execute_command(
+                arguments, working_directory, stdin=encoded, extra_environment=environment)
+
+            return (output, encoded)
+
+        future = EXECUTOR.submit(format_contents)
+
+        PENDING_FORMATS[view.id()] = future
+        future.add_done_callback(on_formatted)
+
+    def command_prefix(self, binary):
+        """
+        Return the arguments of the formatter command which do not depend on the active selections.
+        The result is cached until the formatter, binary, syntax, or file name of the view changes.
+        """
+        syntax = self.view.settings().get('syntax')
+        file_name = self.view.file_name()
+        key = (self.formatter, binary, syntax, file_name)
+
+        if self.prefix_key == key:
+            return self.prefix
+
+        prefix = [binary]
+
+        if self.formatter is Formatter.ClangFormat:
+            prefix.extend(['-output-replacements-xml', '-assume-filename', file_name])
 
         elif self.formatter is Formatter.Gn:
-            command.extend(['format', '--stdin'])
+            prefix.extend(['format', '--stdin'])
+
+        elif self.formatter is Formatter.Prettier and is_prettierd(binary):
+            # prettierd infers the parser from the file name.
+            prefix.append(file_name)
 
         elif self.formatter is Formatter.Prettier:
-            syntax = self.view.settings().get('syntax')
             (syntax, _) = os.path.splitext(syntax)
 
             if syntax.endswith('HTML'):
-                command.extend(['--parser', 'html'])
+                prefix.extend(['--parser', 'html'])
             elif syntax.endswith('JSON'):
-                command.extend(['--parser', 'json'])
+                prefix.extend(['--parser', 'json'])
             elif syntax.endswith('TypeScript'):
-                command.extend(['--parser', 'typescript'])
+                prefix.extend(['--parser', 'typescript'])
             else:
-                command.extend(['--parser', 'babel'])
+                prefix.extend(['--parser', 'babel'])
 
-            for region in selected_regions():
-                command.extend(['--range-start', str(region.begin())])
-                command.extend(['--range-end', str(region.end())])
-                break
-
-        working_directory = os.path.dirname(self.view.file_name())
+        self.prefix_key = key
+        self.prefix = tuple(prefix)
 
-        region = sublime.Region(0, self.view.size())
-        contents = self.view.substr(region)
-
-        contents = execute_command(
-            command, working_directory, stdin=contents, extra_environment=self.environment)
-
-        if contents:
-            position = self.view.viewport_position()
-            self.view.replace(edit, region, contents)
-
-            # This is a bit of a hack. If the selection extends horizontally beyond the viewport,
-            # the call to view.replace sometimes scrolls off to the right. This resets the viewport
-            # position, but first sets the position to (0, 0) - otherwise the 'real' invocation
-            # doesn't seem to have any effect.
-            # https://github.com/sublimehq/sublime_text/issues/2560
-            self.view.set_viewport_position((0, 0), False)
-            self.view.set_viewport_position(position, False)
+        return self.prefix
 
     def is_enabled(self):
-        if self.binary is None:
-            self.initialize()
+        # Resolve the formatter every time, in case the view's syntax or file name has changed. This
+        # is a single cache lookup if nothing has changed.
+        self.initialize()
         return self.binary is not None
 
     def is_visible(self):
         return self.is_enabled()
 
 
+class FormatFileReplaceCommand(sublime_plugin.TextCommand):
+    """
+    Command to apply a formatter's replacements to a file. Each replacement is a list of the
+    beginning and end offsets of the region to replace, and the text to replace it with. The
+    replacements are skipped if the file has been modified since the formatter was invoked. If
+    |save| is true, the file is saved again after the replacements are applied.
+    """
+
+    def run(self, edit, replacements, change_count, save=False):
+        if self.view.change_count() != change_count:
+            return
+
+        position = self.view.viewport_position()
+
+        # Apply the replacements from the end of the file, so that the offsets of the remaining
+        # replacements are not affected by the replacements already made.
+        for (begin, end, text) in reversed(replacements):
+            self.view.replace(edit, sublime.Region(begin, end), text)
+
+        # This is a bit of a hack. If the selection extends horizontally beyond the viewport, the
+        # call to view.replace sometimes scrolls off to the right. This resets the viewport
+        # position, but first sets the position to (0, 0) - otherwise the 'real' invocation doesn't
+        # seem to have any effect.
+        # https://github.com/sublimehq/sublime_text/issues/2560
+        self.view.set_viewport_position((0, 0), False)
+        self.view.set_viewport_position(position, False)
+
+        if save:
+            FORMATTED_VIEWS[self.view.id()] = self.view.change_count()
+            SAVING_VIEWS.add(self.view.id())
+            self.view.run_command('save')
+
+
 class FormatFileListener(sublime_plugin.EventListener):
     """
-    Plugin to run FormatFileCommand on a file when it is saved. This plugin is disabled by default.
-    It may be enabled by setting |on_save| to true in each project settings. Example:
+    Plugin to run FormatFileCommand on a file when it is saved. The file is formatted in the
+    background after it is saved, and is saved again once formatting completes. This plugin is
+    disabled by default. It may be enabled by setting |on_save| to true in each project settings.
+    Example:
 
         {
             "folders": [],
@@ -390,15 +863,50 @@ class FormatFileListener(sublime_plugin.EventListener):
         }
     """
 
-    def on_pre_save(self, view):
-        formatter = formatter_type(view)
+    def on_load_project(self, window):
+        self._clear_project_cache(window)
+
+    def on_activated(self, view):
+        self._clear_project_cache(view.window())
+
+        VIEW_CACHE.pop(view.id(), None)
+        FORMATTED_VIEWS.pop(view.id(), None)
+        BINARY_CACHE.clear()
+        list_directory.cache_clear()
+        expand_variables.cache_clear()
+
+    def on_close(self, view):
+        VIEW_CACHE.pop(view.id(), None)
+        FORMATTED_VIEWS.pop(view.id(), None)
+        SAVING_VIEWS.discard(view.id())
+
+    def on_post_save(self, view):
+        # Reload the project settings if they may have been modified.
+        if (view.file_name() or '').endswith('.sublime-project'):
+            self._clear_project_cache(view.window())
+
+        # Don't format the file again if this plugin is what saved it.
+        if view.id() in SAVING_VIEWS:
+            SAVING_VIEWS.discard(view.id())
+            return
+
+        # Don't format the file again if it has not been modified since it was last formatted.
+        if FORMATTED_VIEWS.get(view.id()) == view.change_count():
+            return
+
+        (formatter, binary) = resolve_formatter(view)
 
-        if formatter is None:
+        if (formatter is None) or (binary is None):
             return
         elif not self._is_enabled(formatter, view):
             return
 
-        view.run_command('format_file', {'ignore_selections': True})
+        view.run_command('format_file', {
+            'ignore_selections': True,
+            'save': True,
+            'formatter': str(formatter),
+            'binary': binary,
+        })
 
     def _is_enabled(self, formatter, view):
         format_on_save = get_project_setting(formatter, 'on_save')
@@ -408,15 +916,43 @@ class FormatFileListener(sublime_plugin.EventListener):
         elif not isinstance(format_on_save, list):
             return False
 
-        folder_data = self._get_folder_data(view.window())
-        file_name = view.file_name()
+        enabled_folders = self._get_enabled_folders(view.window(), format_on_save)
+        directory = os.path.normcase(os.path.dirname(view.file_name()))
+
+        # Walk up from the file's directory to check if it is within any of the enabled folders.
+        while directory not in enabled_folders:
+            (directory, parent) = (os.path.dirname(directory), directory)
 
-        return any(file_name.startswith(folder_data[f]) for f in format_on_save)
+            if directory == parent:
+                return False
+
+        return True
+
+    def _get_enabled_folders(self, window, folder_names):
+        """
+        Get the set of normalized paths to the project folders with the given names. The set is
+        cached per window until the project's cache is cleared.
+        """
+        enabled_folders = ENABLED_FOLDERS.setdefault(window.id(), {})
+        folder_names = tuple(folder_names)
+
+        if folder_names not in enabled_folders:
+            folder_data = self._get_folder_data(window)
+
+            enabled_folders[folder_names] = frozenset(
+                os.path.normcase(os.path.normpath(folder_data[name]))
+                for name in folder_names if name in folder_data)
+
+        return enabled_folders[folder_names]
 
     def _get_folder_data(self, window):
         """
         Get a dictionary of project folders mapping folder names to the full path to the folder.
+        The dictionary is cached per window until the project's cache is cleared.
         """
+        if window.id() in FOLDER_DATA:
+            return FOLDER_DATA[window.id()]
+
         project_variables = window.extract_variables()
         project_data = window.project_data()
 
@@ -428,4 +964,26 @@ class FormatFileListener(sublime_plugin.EventListener):
                 path = os.path.join(project_path, folder['path'])
                 folder_data[folder['name']] = path
 
+        FOLDER_DATA[window.id()] = folder_data
         return folder_data
+
+    def _clear_project_cache(self, window):
+        """
+        Clear any cached data loaded from the given window's project.
+        """
+        if window is not None:
+            PROJECT_SETTINGS.pop(window.id(), None)
+            FOLDER_DATA.pop(window.id(), None)
+            ENABLED_FOLDERS.pop(window.id(), None)
+
+
+def plugin_unloaded():
+    """
+    Stop running formatters when the plugin is unloaded or reloaded, so that each reload does not
+    leak the previous executor and its worker threads.
+    """
+    for future in PENDING_FORMATS.values():
+        future.cancel()
+
+    PENDING_FORMATS.clear()
+    EXECUTOR.shutdown(wait=False)